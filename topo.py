@@ -1,20 +1,73 @@
 import argparse
 import logging
-import humanize
+import os
+from concurrent.futures import ThreadPoolExecutor
 
-from stl import mesh
+import humanize
 
 from matplotlib import pyplot
 import numpy as np
 
-from struct import pack
+from struct import Struct
 import rasterio
 import rasterio.mask as mask
+from rasterio.coords import BoundingBox
 from rasterio.io import MemoryFile
+from rasterio.transform import array_bounds
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 
 logging.basicConfig(level=logging.INFO)
 
+# working memory (MB) GDAL may use when reprojecting
+WARP_MEM_LIMIT = 512
+
+# binary STL: 80 byte header, little endian uint32 facet count, then the facets
+STL_HEADER = Struct('<80sI')
+# 50 byte facet record: normal, three vertices and an unused attribute
+STL_FACET = np.dtype([('normals', '<f4', (3,)), ('vectors', '<f4', (3, 3)), ('attr', '<u2')])
+
+# number of raster pixels meshed at a time. Every pixel needs several temporary
+# arrays, so this bounds the temporaries each stripe (and thread) allocates to
+# tens of MB, rather than many times the raster size. Stripes are whole rows,
+# so wide rasters get fewer rows per stripe. 256K was the fastest size measured
+STRIPE_PIXELS = 1 << 18
+
+
+# raster data held as a plain (bands, height, width) array along with the
+# dataset 'meta' describing it. Intermediate steps return these rather than
+# encoding a GTiff into a MemoryFile only for the next step to decode it again.
+# Has just as much of the dataset interface as reproject_ds needs
+class InMemoryRaster:
+    __slots__ = ('data', 'meta')
+
+    def __init__(self, data, meta):
+        self.data = data
+        self.meta = meta
+
+    @property
+    def crs(self):
+        return self.meta["crs"]
+
+    @property
+    def transform(self):
+        return self.meta["transform"]
+
+    @property
+    def nodata(self):
+        return self.meta["nodata"]
+
+    @property
+    def width(self):
+        return self.meta["width"]
+
+    @property
+    def height(self):
+        return self.meta["height"]
+
+    @property
+    def bounds(self):
+        return BoundingBox(*array_bounds(self.height, self.width, self.transform))
+
 
 def resample(src, factor):
     meta = src.meta.copy()
@@ -40,12 +93,10 @@ def resample(src, factor):
                  "width": data.shape[-1],
                  "transform": transform})
 
-    m = MemoryFile().open(**meta)
-    m.write(data)
-    return m
+    return InMemoryRaster(data, meta)
 
 
-def reproject_ds(src, dest_crs):
+def reproject_ds(src, dest_crs, num_threads=os.cpu_count()):
     # reproject
     transform, width, height = calculate_default_transform(
         src.crs, dest_crs, src.width, src.height, *src.bounds)
@@ -57,17 +108,27 @@ def reproject_ds(src, dest_crs):
         'height': height
     })
 
+    # the result is a real dataset, since cropping needs one
     dst = MemoryFile().open(**kwargs)
 
-    for i in range(1, src.count + 1):
-        reproject(
-            source=rasterio.band(src, i),
-            destination=rasterio.band(dst, i),
-            src_transform=src.transform,
-            src_crs=src.crs,
-            dst_transform=transform,
-            dst_crs=dest_crs,
-            resampling=Resampling.nearest)
+    # arrays are warped as they are, datasets are read by GDAL as it goes
+    if isinstance(src, InMemoryRaster):
+        source = src.data
+    else:
+        source = rasterio.band(src, src.indexes)
+
+    # all bands at once, so one GDAL warp operation is split across the threads
+    reproject(
+        source=source,
+        destination=rasterio.band(dst, dst.indexes),
+        src_transform=src.transform,
+        src_crs=src.crs,
+        src_nodata=src.nodata,
+        dst_transform=transform,
+        dst_crs=dest_crs,
+        resampling=Resampling.nearest,
+        num_threads=num_threads,
+        warp_mem_limit=WARP_MEM_LIMIT)
 
     return dst
 
@@ -102,9 +163,133 @@ def crop(src, crop_args):
                  "width": out_image.shape[2],
                  "transform": out_transform})
 
-    m = MemoryFile().open(**meta)
-    m.write(out_image)
-    return m
+    return InMemoryRaster(out_image, meta)
+
+
+# cast mesh coordinates down to float32. Values outside the float32 range
+# (extreme z scales mostly) are clamped to it rather than becoming inf
+def to_float32(values):
+    limit = np.finfo(np.float32).max
+    return np.clip(values, -limit, limit).astype(np.float32)
+
+
+# I basically stole this whole routine from phstl, but every pixel of a stripe
+# is handled at once with numpy arrays instead of looping over it in python.
+# 'pixels', 'valid' and 'ys' include the row below the stripe for the b and d corners.
+# The stripe's facets are written to the 'out' records, which must fit them exactly
+def mesh_stripe(pixels, valid, xs, ys, zscale, zmin, out):
+    # the x and y coordinate tables are broadcast across the stripe's points
+    points = np.empty(pixels.shape + (3,), dtype=np.float32)
+    points[..., 0] = xs
+    points[..., 1] = ys[:, np.newaxis]
+    points[..., 2] = to_float32(zscale * (pixels.astype(np.float64) - zmin))
+
+    # Each pixel (a) and its neighbors (b, c, and d) make up two facets:
+    #
+    # a-c   a-c     c
+    # |/| = |/  +  /|
+    # b-d   b     b-d
+    a, av = points[:-1, :-1], valid[:-1, :-1]
+    b, bv = points[1:, :-1], valid[1:, :-1]
+    c, cv = points[:-1, 1:], valid[:-1, 1:]
+    d, dv = points[1:, 1:], valid[1:, 1:]
+
+    # Points b and c are required for both facets, so if either are
+    # unavailable, that pixel is skipped altogether.
+    valid_bc = bv & cv
+
+    # shape (rows, mw, 2, 3, 3): per pixel, the (a, b, c) and (d, c, b) facets.
+    # Masking keeps the facets in the same order as a row by row walk would
+    facets = np.stack((np.stack((a, b, c), axis=2), np.stack((d, c, b), axis=2)), axis=2)
+    keep = np.stack((valid_bc & av, valid_bc & dv), axis=2)
+    facets = facets[keep]
+    out['vectors'] = facets
+    out['normals'] = compute_normals(facets)
+
+
+# generate the mesh into the 'out' facet records, returning how many were written.
+# Stripes are meshed by a pool of threads, as numpy releases the GIL while it works
+def generate_mesh(pixels, nodata, xscale, yscale, zscale, out, xmin=0, ymin=0, zmin=0,
+                  num_threads=os.cpu_count()):
+    # Apply transforms to obtain output mesh coordinates of every raster
+    # column and row, once for the whole raster as float32 lookup tables.
+    # Coordinates are computed as doubles and only then cast down.
+    # TODO for each axis I am only considering one aspect of the Affine transformation,
+    # but that probably wont work out for non rectangles. See phstl
+    xs = to_float32(xscale * (xmin + np.arange(pixels.shape[1])))
+    ys = to_float32(yscale * (ymin + np.arange(pixels.shape[0])))
+
+    # pixels that are not nodata. NaN pixels have no height to clamp, so they
+    # are never valid, which also covers NaN nodata that never compares equal
+    valid = ~np.isnan(pixels)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= pixels != nodata
+
+    # facets each row of pixels makes, using the same rules as mesh_stripe. With
+    # those, every stripe knows up front where its facets go in 'out', so the
+    # stripes can be written there by any thread in any order
+    valid_bc = valid[1:, :-1] & valid[:-1, 1:]
+    row_facets = (valid_bc & valid[:-1, :-1]).sum(axis=1) + (valid_bc & valid[1:, 1:]).sum(axis=1)
+    offsets = np.concatenate(([0], np.cumsum(row_facets)))
+    del valid_bc
+
+    mh = pixels.shape[0] - 1
+    stripe_rows = max(1, STRIPE_PIXELS // pixels.shape[1])
+
+    def mesh(y):
+        end = min(y + stripe_rows, mh)
+        rows = slice(y, end + 1)
+        mesh_stripe(pixels[rows], valid[rows], xs, ys[rows], zscale, zmin, out[offsets[y]:offsets[end]])
+        return end
+
+    last_progress = None
+    with ThreadPoolExecutor(num_threads) as pool:
+        for end in pool.map(mesh, range(0, mh, stripe_rows)):
+            # only update the progress line when it moves by at least a percent
+            progress = (end * 100) // mh
+            if progress != last_progress:
+                print(f"== generating mesh: {progress}%", end='\r')
+                last_progress = progress
+
+    print()
+    return int(offsets[-1])
+
+
+# unit normal of each (N, 3, 3) facet, following the right hand rule
+def compute_normals(facets):
+    normals = np.cross(facets[:, 0] - facets[:, 1], facets[:, 1] - facets[:, 2])
+    # row lengths with einsum, which skips the temporaries np.linalg.norm makes
+    length = np.sqrt(np.einsum('ij,ij->i', normals, normals))[:, np.newaxis]
+    # degenerate (zero area) facets keep a zero normal instead of NaN
+    np.divide(normals, length, out=normals, where=length > 0)
+    return normals
+
+
+# create a binary STL at 'path' with room for 'max_facets' facets, returning a
+# memory map of its facet records. Facets written to it go straight to the file,
+# so the mesh never has to fit in memory
+def create_stl(path, max_facets):
+    # an empty region can not be mapped, so there is always room for one facet
+    max_facets = max(max_facets, 1)
+    with open(path, 'wb') as f:
+        f.truncate(STL_HEADER.size + max_facets * STL_FACET.itemsize)
+    return np.memmap(path, dtype=STL_FACET, mode='r+', offset=STL_HEADER.size, shape=max_facets)
+
+
+# write the header for the 'count' facets actually written to a file from
+# create_stl, and cut off the unused room. The memory map must be closed first
+def finish_stl(path, count):
+    with open(path, 'r+b') as f:
+        f.write(STL_HEADER.pack(b'topo_tool', count))
+        f.truncate(STL_HEADER.size + count * STL_FACET.itemsize)
+
+
+# argparse type for counts that must be at least 1
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
 
 
 if __name__ == "__main__":
@@ -120,6 +305,8 @@ if __name__ == "__main__":
     ap.add_argument('-S', '--show', action='store_true', default=False, help='plot the final area')
     ap.add_argument('-z', '--zscale', action='store', default=1.0, type=float, help='Z scale modifier')
     ap.add_argument('-f', '--force', action='store_true', default=False, help='Force unprojected/unitless data')
+    ap.add_argument('-j', '--threads', action='store', default=os.cpu_count(), type=positive_int,
+                    help='Number of threads to use. Defaults to the number of CPUs')
     args = ap.parse_args()
 
     with rasterio.open(args.RASTER) as src:
@@ -132,37 +319,43 @@ if __name__ == "__main__":
             # cropping to lat/long
             global_crs = "EPSG:4326"
             orig_crs = src.crs
-            src = reproject_ds(src, "EPSG:4326")
+            src = reproject_ds(src, "EPSG:4326", args.threads)
             logging.info(f"cropping to {args.crop}")
             src = crop(src, args.crop)
-            src = reproject_ds(src, orig_crs)
+            src = reproject_ds(src, orig_crs, args.threads)
 
-        # resample
+        # resample. If nothing comes after it, the band is read straight at
+        # the new size below instead, so GDAL can use overviews rather than
+        # decoding every band at full resolution into a MemoryFile
+        factor = 1.0
         if args.resample:
             logging.info(f"resampling at {args.resample}")
             logging.info(f"original (width, height): ({src.width}, {src.height})")
-            src = resample(src, args.resample)
-            logging.info(f"new (width, height): ({src.width}, {src.height})")
+            if args.reproject:
+                src = resample(src, args.resample)
+            else:
+                factor = args.resample
+            logging.info(f"new (width, height): ({int(src.width * factor)}, {int(src.height * factor)})")
 
         # reproject
         if args.reproject:
             logging.info(f"reprojecting to {args.reproject}")
-            src = reproject_ds(src, args.reproject)
+            src = reproject_ds(src, args.reproject, args.threads)
 
-        trans = src.transform
+        # scale image transform to the size the band is read at
+        height = int(src.height * factor)
+        width = int(src.width * factor)
+        trans = src.transform * src.transform.scale(src.width / width, src.height / height)
         logging.info("transform: {}".format(repr(trans).replace("\n", "").replace(" ", "")))
 
         profile = src.profile
         nodata = profile["nodata"]
         logging.info(f"nodata value: {nodata}")
 
-        # function to skip if nodata value
-        skip = lambda x: x == nodata
-
         crs = profile["crs"]
         logging.info(f"crs: {crs}")
         logging.info(f"units: {crs.linear_units}")
-        logging.info(f"resolution: {src.res}")
+        logging.info(f"resolution: {(trans.a, -trans.e)}")
         logging.info(f"projected: {crs.is_projected}")
         logging.info(f"bounds: {src.bounds}")
 
@@ -193,9 +386,18 @@ if __name__ == "__main__":
             else:
                 raise Exception(warning)
 
-        # read band #1 to get the actual pixel array
+        # read band #1 to get the actual pixel array. It is read straight into
+        # float32, whatever the raster dtype, since that is what the mesh uses
         # TODO this might not always be band #1?
-        pixels = src.read(1)
+        pixels = np.empty((height, width), dtype=np.float32)
+        src.read(1, out=pixels, resampling=Resampling.bilinear)
+
+        # compare against nodata at the same float32 precision as the pixels.
+        # float64 nodata outside the float32 range (e.g. -DBL_MAX) becomes
+        # +/-inf, which is intended: GDAL converts those pixels to inf too
+        if nodata is not None:
+            with np.errstate(over='ignore'):
+                nodata = np.float32(nodata)
 
     # output mesh dimensions are one row and column less than raster window
     mw = pixels.shape[1] - 1  # width X
@@ -214,74 +416,19 @@ if __name__ == "__main__":
     zscale = trans.i * args.zscale
     logging.info(f"xscale: {xscale} yscale: {yscale} zscale: {zscale}")
 
-    # I basically store this whole routine from phstl
-    faces = []
-    for y in range(mh):
-        progress = (y / mh) * 100
-        print(f"== generating mesh: {progress:.2f}%", end='\r')
-
-        for x in range(mw):
-
-            # Elevation values of this pixel (a) and its neighbors (b, c, and d).
-            av = pixels[y][x]
-            bv = pixels[y + 1][x]
-            cv = pixels[y][x + 1]
-            dv = pixels[y + 1][x + 1]
-
-            # Apply transforms to obtain output mesh coordinates of the
-            # four corners composed of raster points a (x, y), b, c,
-            # and d (x + 1, y + 1):
-            #
-            # a-c   a-c     c
-            # |/| = |/  +  /|
-            # b-d   b     b-d
-
-            # Points b and c are required for both facets, so if either
-            # are unavailable, we can skip this pixel altogether.
-            if skip(bv) or skip(cv):
-                continue
-
-            # TODO for each axis I am only considering one aspect of the Affine transformation,
-            # but that probably wont work out for non rectangles. See phstl
-            b = (
-                np.float32(xscale * (xmin + x)),
-                np.float32(yscale * (ymin + y + 1)),
-                np.float32(zscale * (float(bv) - zmin))
-            )
-
-            c = (
-                np.float32(xscale * (xmin + x + 1)),
-                np.float32(yscale * (ymin + y)),
-                np.float32(zscale * (float(cv) - zmin))
-            )
-
-            if not skip(av):
-                a = (
-                    np.float32(xscale * (xmin + x)),
-                    np.float32(yscale * (ymin + y)),
-                    np.float32(zscale * (float(av) - zmin))
-                )
-                faces.append((a, b, c))
-
-            if not skip(dv):
-                d = (
-                    np.float32(xscale * (xmin + x + 1)),
-                    np.float32(yscale * (ymin + y + 1)),
-                    np.float32(zscale * (float(dv) - zmin))
-                )
-                faces.append((d, c, b))
-
-    logging.info(f"generated mesh has {len(faces)} faces")
-
-    logging.info(f"writing STL...")
-    # instantiate mesh based on the number of faces we generates
-    stl = mesh.Mesh(np.zeros(len(faces), dtype=mesh.Mesh.dtype), remove_empty_areas=False)
-    stl.vectors = faces
-    stl.save(args.STL, update_normals=True)  # TODO not sure why I am updating normals, but ok
+    # facets are generated straight into the output file
+    faces = create_stl(args.STL, est_triangles)
+    count = generate_mesh(pixels, nodata, xscale, yscale, zscale, faces, xmin, ymin, zmin, args.threads)
+    faces.flush()
+    del faces
+
+    finish_stl(args.STL, count)
+    logging.info(f"generated mesh has {count} faces")
+    logging.info(f"wrote STL: {humanize.naturalsize(os.path.getsize(args.STL))}")
 
     # show it
     if args.show:
-        pyplot.imshow(src.read(1), cmap='pink')
+        pyplot.imshow(pixels, cmap='pink')
         pyplot.show()
 
     logging.info("finished!")